@@ -5,38 +5,233 @@ Handles push subscriptions, notifications, and settings.
 """
 
 import os
+import base64
+import queue
+import atexit
+import logging
 import sqlite3
+import threading
+from pathlib import Path
 from typing import List, Optional
 from contextlib import contextmanager
 
+logger = logging.getLogger(__name__)
+
 DB_PATH = os.environ.get('DB_PATH', '/app/data/claude_notify.db')
 
+# Size of sqlite3's per-connection prepared statement cache. Comfortably
+# larger than the fixed set of queries below, so none are ever re-prepared.
+STATEMENT_CACHE_SIZE = 64
+
+# Read-only connections kept open alongside the single writer. Under WAL
+# they read concurrently with each other and with the writer.
+READER_POOL_SIZE = 4
+
+# Query text is kept in module-level constants so every call passes the
+# identical string and hits the connection's statement cache.
+_SQL_SAVE_SUB = """
+    INSERT INTO push_subscriptions (endpoint, p256dh, auth)
+    VALUES (?, ?, ?)
+    ON CONFLICT(endpoint) DO UPDATE SET
+        p256dh = excluded.p256dh,
+        auth = excluded.auth,
+        last_used = CURRENT_TIMESTAMP
+"""
+_SQL_TEXT_KEY_SUBS = """
+    SELECT id, p256dh, auth FROM push_subscriptions
+    WHERE typeof(p256dh) = 'text' OR typeof(auth) = 'text'
+"""
+_SQL_UPDATE_SUB_KEYS = "UPDATE push_subscriptions SET p256dh = ?, auth = ? WHERE id = ?"
+_SQL_REMOVE_SUB_BY_ID = "DELETE FROM push_subscriptions WHERE id = ?"
+_SQL_REMOVE_SUB = "DELETE FROM push_subscriptions WHERE endpoint = ?"
+_SQL_ALL_SUBS = "SELECT endpoint, p256dh, auth FROM push_subscriptions"
+_SQL_UPDATE_LAST_USED = "UPDATE push_subscriptions SET last_used = CURRENT_TIMESTAMP WHERE endpoint = ?"
+_SQL_COUNT_SUBS = "SELECT COUNT(*) FROM push_subscriptions"
+_SQL_SAVE_NOTIFICATION = """
+    INSERT INTO claude_notifications
+    (notification_type, title, body, project_path, status, scheduled_at)
+    VALUES (?, ?, ?, ?, 'pending', datetime('now', ?))
+    RETURNING id
+"""
+_NOTIFICATION_COLUMNS = ('id', 'timestamp', 'notification_type', 'title', 'body',
+                         'project_path', 'status', 'scheduled_at')
+_SQL_NOTIFICATION_HISTORY = f"""
+    SELECT {', '.join(_NOTIFICATION_COLUMNS)} FROM claude_notifications
+    ORDER BY timestamp DESC
+    LIMIT ?
+"""
+_SQL_UPDATE_NOTIFICATION_STATUS = "UPDATE claude_notifications SET status = ? WHERE id = ?"
+_SQL_GET_NOTIFICATION = "SELECT * FROM claude_notifications WHERE id = ?"
+_SQL_EXPIRE_LEGACY_WAITING = """
+    UPDATE claude_notifications SET status = 'cancelled'
+    WHERE status = 'pending' AND notification_type = 'waiting' AND scheduled_at IS NULL
+      AND datetime(timestamp, '+120 seconds') <= CURRENT_TIMESTAMP
+"""
+_SQL_BACKFILL_SCHEDULED_AT = """
+    UPDATE claude_notifications SET scheduled_at = datetime(timestamp, '+120 seconds')
+    WHERE status = 'pending' AND notification_type = 'waiting' AND scheduled_at IS NULL
+"""
+_SQL_DUE_NOTIFICATIONS = """
+    SELECT id FROM claude_notifications
+    WHERE status = 'pending' AND scheduled_at <= CURRENT_TIMESTAMP
+    ORDER BY scheduled_at
+    LIMIT ?
+"""
+_SQL_CLAIM_NOTIFICATION = """
+    UPDATE claude_notifications SET status = 'delivered'
+    WHERE id = ? AND status = 'pending'
+    RETURNING title, body
+"""
+_SQL_CANCEL_NOTIFICATION = """
+    UPDATE claude_notifications SET status = 'cancelled'
+    WHERE id = ? AND status = 'pending' AND scheduled_at IS NOT NULL
+"""
+_SQL_GET_SETTING = "SELECT value FROM settings WHERE key = ?"
+_SQL_SET_SETTING = """
+    INSERT INTO settings (key, value) VALUES (?, ?)
+    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+"""
+
+
+def _b64url_decode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def _decode_subscription_keys(p256dh, auth) -> tuple:
+    """Decode base64url subscription keys, raising ValueError if unusable."""
+    p256dh = _b64url_decode(p256dh)
+    auth = _b64url_decode(auth)
+    # An uncompressed P-256 point and a 16 byte auth secret (RFC 8291)
+    if len(p256dh) != 65 or p256dh[0] != 0x04 or len(auth) != 16:
+        raise ValueError("unexpected key length")
+    return p256dh, auth
+
 
 class Database:
     def __init__(self, db_path: str = None):
         self.db_path = db_path or DB_PATH
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        if not self.db_path.endswith(':memory:'):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._writer = None
+        self._lock = threading.Lock()
+        self._readers = None
+        self._closed = False
         self._init_db()
+        # An in-memory database is private to its connection, so reads
+        # there go through the writer instead of a pool.
+        if not self.db_path.endswith(':memory:'):
+            self._readers = queue.Queue()
+            for _ in range(READER_POOL_SIZE):
+                self._readers.put(self._connect(read_only=True))
 
-    @contextmanager
-    def _get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            uri = Path(self.db_path).absolute().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   isolation_level=None,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            # Autocommit: single statements commit on their own, and
+            # multi-statement writes use _transaction() explicitly.
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   isolation_level=None,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
+        if not read_only and not self.db_path.endswith(':memory:'):
+            # WAL lets readers proceed during writes; NORMAL skips the
+            # per-commit fsync, which is safe in WAL mode.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    @contextmanager
+    def _write_connection(self):
+        # One long-lived writer shared by all threads, so SQLite's page
+        # cache stays warm between requests. The lock serializes access.
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+            if self._writer is None:
+                self._writer = self._connect()
+            yield self._writer
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block of writes as one BEGIN IMMEDIATE ... COMMIT transaction."""
+        with self._write_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                # A failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction
+                # open on the shared writer, while some errors make SQLite
+                # roll back on its own; only roll back what is still open.
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    @contextmanager
+    def _read_connection(self):
+        if self._readers is None:
+            with self._write_connection() as conn:
+                yield conn
+            return
+        conn = self._readers.get()
+        if conn is None:
+            # close() left a sentinel to wake waiters; pass it on.
+            self._readers.put(None)
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
         try:
             yield conn
         finally:
-            conn.close()
+            if self._closed:
+                conn.close()
+            else:
+                self._readers.put(conn)
+                # close() may have drained the pool just before the put.
+                if self._closed:
+                    self._close_idle_readers()
+
+    def _close_idle_readers(self):
+        while True:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+        self._readers.put(None)
+
+    def close(self):
+        """Run PRAGMA optimize and close all connections.
+
+        Readers still checked out are closed when they are returned.
+        """
+        self._closed = True
+        if self._readers is not None:
+            self._close_idle_readers()
+        with self._lock:
+            if self._writer is not None:
+                self._writer.execute("PRAGMA optimize")
+                self._writer.close()
+                self._writer = None
 
     def _init_db(self):
-        with self._get_connection() as conn:
+        with self._transaction() as conn:
             cursor = conn.cursor()
 
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS push_subscriptions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     endpoint TEXT UNIQUE NOT NULL,
-                    p256dh TEXT NOT NULL,
-                    auth TEXT NOT NULL,
+                    p256dh BLOB NOT NULL,
+                    auth BLOB NOT NULL,
                     created_at TEXT DEFAULT CURRENT_TIMESTAMP,
                     last_used TEXT
                 )
@@ -50,10 +245,41 @@ class Database:
                     title TEXT NOT NULL,
                     body TEXT,
                     project_path TEXT,
-                    status TEXT DEFAULT 'pending'
+                    status TEXT DEFAULT 'pending',
+                    scheduled_at TEXT
                 )
             """)
 
+            # Older databases stored subscription keys as base64url text.
+            # Column affinity never converts BLOB values, so decoding the
+            # rows in place is enough without rebuilding the table.
+            # Keys that never were valid base64url (the old subscribe route
+            # stored any string) cannot be used to send, so drop those rows.
+            cursor.execute(_SQL_TEXT_KEY_SUBS)
+            legacy = []
+            malformed = []
+            for row in cursor.fetchall():
+                try:
+                    legacy.append((*_decode_subscription_keys(row['p256dh'], row['auth']), row['id']))
+                except (TypeError, ValueError):
+                    logger.warning(f"Removing subscription {row['id']} with malformed keys")
+                    malformed.append((row['id'],))
+            if legacy:
+                cursor.executemany(_SQL_UPDATE_SUB_KEYS, legacy)
+            if malformed:
+                cursor.executemany(_SQL_REMOVE_SUB_BY_ID, malformed)
+
+            # Older databases predate the scheduled_at column
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(claude_notifications)")}
+            if 'scheduled_at' not in columns:
+                cursor.execute("ALTER TABLE claude_notifications ADD COLUMN scheduled_at TEXT")
+            # Waiting notifications left pending by the old in-process timers
+            # get the default delay, so the scheduler delivers them and they
+            # can be cancelled. Those already past that delay are stale, so
+            # cancel them rather than push them all on the first poll.
+            cursor.execute(_SQL_EXPIRE_LEGACY_WAITING)
+            cursor.execute(_SQL_BACKFILL_SCHEDULED_AT)
+
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS settings (
                     key TEXT PRIMARY KEY,
@@ -61,7 +287,21 @@ class Database:
                 )
             """)
 
-            conn.commit()
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_notifications_timestamp
+                ON claude_notifications(timestamp DESC)
+            """)
+
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_notifications_pending
+                ON claude_notifications(status, scheduled_at)
+            """)
+
+            # Covers get_all_push_subscriptions so it is served from the index.
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_subs_covering
+                ON push_subscriptions(endpoint, p256dh, auth)
+            """)
 
     def save_push_subscription(self, subscription: dict) -> bool:
         endpoint = subscription.get('endpoint')
@@ -72,101 +312,161 @@ class Database:
         if not all([endpoint, p256dh, auth]):
             raise ValueError("Invalid subscription: missing required fields")
 
-        with self._get_connection() as conn:
+        # Keys arrive base64url encoded; store the raw bytes so sending
+        # never has to decode them.
+        try:
+            p256dh, auth = _decode_subscription_keys(p256dh, auth)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid subscription: malformed keys")
+
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO push_subscriptions (endpoint, p256dh, auth)
-                VALUES (?, ?, ?)
-                ON CONFLICT(endpoint) DO UPDATE SET
-                    p256dh = excluded.p256dh,
-                    auth = excluded.auth,
-                    last_used = CURRENT_TIMESTAMP
-            """, (endpoint, p256dh, auth))
-            conn.commit()
+            cursor.execute(_SQL_SAVE_SUB, (endpoint, p256dh, auth))
             return True
 
     def remove_push_subscription(self, endpoint: str) -> bool:
-        with self._get_connection() as conn:
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM push_subscriptions WHERE endpoint = ?", (endpoint,))
-            conn.commit()
+            cursor.execute(_SQL_REMOVE_SUB, (endpoint,))
             return cursor.rowcount > 0
 
     def get_all_push_subscriptions(self) -> List[dict]:
-        with self._get_connection() as conn:
+        with self._read_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT endpoint, p256dh, auth FROM push_subscriptions")
+            cursor.execute(_SQL_ALL_SUBS)
             return [dict(row) for row in cursor.fetchall()]
 
     def update_push_subscription_last_used(self, endpoint: str):
-        with self._get_connection() as conn:
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE push_subscriptions SET last_used = CURRENT_TIMESTAMP WHERE endpoint = ?
-            """, (endpoint,))
-            conn.commit()
+            cursor.execute(_SQL_UPDATE_LAST_USED, (endpoint,))
+
+    def mark_endpoints_used(self, endpoints: List[str]):
+        """Bump last_used for many subscriptions in a single transaction."""
+        if not endpoints:
+            return
+        with self._transaction() as conn:
+            conn.executemany(_SQL_UPDATE_LAST_USED, [(e,) for e in endpoints])
+
+    def remove_push_subscriptions(self, endpoints: List[str]) -> int:
+        """Delete many subscriptions in a single transaction."""
+        if not endpoints:
+            return 0
+        with self._transaction() as conn:
+            cursor = conn.executemany(_SQL_REMOVE_SUB, [(e,) for e in endpoints])
+        return cursor.rowcount
 
     def get_subscription_count(self) -> int:
-        with self._get_connection() as conn:
+        with self._read_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM push_subscriptions")
+            cursor.execute(_SQL_COUNT_SUBS)
             return cursor.fetchone()[0]
 
     def save_claude_notification(self, notification_type: str, title: str,
-                                  body: str = None, project_path: str = None) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO claude_notifications
-                (notification_type, title, body, project_path, status)
-                VALUES (?, ?, ?, ?, 'pending')
-            """, (notification_type, title, body, project_path))
-            conn.commit()
-            return cursor.lastrowid
+                                  body: str = None, project_path: str = None,
+                                  delay_seconds: float = None) -> int:
+        """Save a notification. With delay_seconds it is scheduled for later delivery."""
+        return self.save_claude_notifications_bulk([{
+            'notification_type': notification_type,
+            'title': title,
+            'body': body,
+            'project_path': project_path,
+            'delay_seconds': delay_seconds
+        }])[0]
+
+    def save_claude_notifications_bulk(self, rows: List[dict]) -> List[int]:
+        """Save many notifications in one transaction and return their ids.
+
+        Each row takes the keyword arguments of save_claude_notification.
+        """
+        params = []
+        for row in rows:
+            delay_seconds = row.get('delay_seconds')
+            # A NULL modifier makes datetime() return NULL, i.e. not scheduled.
+            modifier = f'{float(delay_seconds):+} seconds' if delay_seconds is not None else None
+            params.append((row['notification_type'], row['title'], row.get('body'),
+                           row.get('project_path'), modifier))
+
+        with self._transaction() as conn:
+            # executemany() discards RETURNING rows, so execute per row
+            # inside the one transaction.
+            return [conn.execute(_SQL_SAVE_NOTIFICATION, p).fetchone()[0] for p in params]
 
     def get_claude_notification_history(self, limit: int = 50) -> List[dict]:
-        with self._get_connection() as conn:
+        with self._read_connection() as conn:
+            # Plain tuples zipped with the known columns skip building a
+            # sqlite3.Row for every row before the dict.
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM claude_notifications
-                ORDER BY timestamp DESC
-                LIMIT ?
-            """, (limit,))
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.row_factory = None
+            cursor.execute(_SQL_NOTIFICATION_HISTORY, (limit,))
+            return [dict(zip(_NOTIFICATION_COLUMNS, row)) for row in cursor.fetchall()]
 
     def update_claude_notification_status(self, notification_id: int, status: str):
-        with self._get_connection() as conn:
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE claude_notifications SET status = ? WHERE id = ?
-            """, (status, notification_id))
-            conn.commit()
+            cursor.execute(_SQL_UPDATE_NOTIFICATION_STATUS, (status, notification_id))
 
     def get_claude_notification(self, notification_id: int) -> Optional[dict]:
-        with self._get_connection() as conn:
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_SQL_GET_NOTIFICATION, (notification_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+    def get_due_notification_ids(self, limit: int = 100) -> List[int]:
+        """Ids of scheduled notifications that are pending and past due."""
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_SQL_DUE_NOTIFICATIONS, (limit,))
+            return [row['id'] for row in cursor.fetchall()]
+
+    def claim_pending_notification(self, notification_id: int) -> Optional[dict]:
+        """Atomically mark a pending notification delivered.
+
+        Returns its title and body, or None if it was not pending.
+        """
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM claude_notifications WHERE id = ?", (notification_id,))
+            cursor.execute(_SQL_CLAIM_NOTIFICATION, (notification_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
 
+    def cancel_pending_notification(self, notification_id: int) -> bool:
+        """Cancel a scheduled notification that has not been delivered yet."""
+        with self._write_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_SQL_CANCEL_NOTIFICATION, (notification_id,))
+            return cursor.rowcount > 0
+
     def get_setting(self, key: str) -> Optional[str]:
-        with self._get_connection() as conn:
+        with self._read_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+            cursor.execute(_SQL_GET_SETTING, (key,))
             row = cursor.fetchone()
             return row['value'] if row else None
 
     def set_setting(self, key: str, value: str):
-        with self._get_connection() as conn:
+        with self._write_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO settings (key, value) VALUES (?, ?)
-                ON CONFLICT(key) DO UPDATE SET value = excluded.value
-            """, (key, value))
-            conn.commit()
+            cursor.execute(_SQL_SET_SETTING, (key, value))
 
     def is_setup_complete(self) -> bool:
         return self.get_setting('setup_complete') == 'true'
 
     def mark_setup_complete(self):
         self.set_setting('setup_complete', 'true')
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db() -> Database:
+    """Return the process-wide shared Database instance."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = Database()
+                atexit.register(_db.close)
+    return _db
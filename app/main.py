@@ -6,16 +6,22 @@ Push notifications for Claude Code.
 
 import os
 import io
+import time
+import hashlib
 import logging
-from threading import Timer
+import functools
+import threading
 from dotenv import load_dotenv
+from dotenv.parser import parse_stream
 
 load_dotenv()
 
-from flask import Flask, request, jsonify, render_template, send_from_directory, Response
+import orjson
+from flask import Flask, request, jsonify, render_template, Response
+from flask.json.provider import JSONProvider
 
-from app.database import Database
-from app.web_push import send_push_to_all, get_vapid_public_key, generate_vapid_keys
+from app.database import get_db
+from app.web_push import send_push_to_all, get_vapid_public_key, generate_vapid_keys, set_vapid_keys
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,17 +29,61 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify()."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # Skip the bytes -> str -> bytes round trip of the base implementation.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__,
             template_folder='templates',
             static_folder='static')
+app.json = OrjsonProvider(app)
+
+# Seconds between scans for scheduled notifications that are due.
+SCHEDULER_INTERVAL = 5
+# Longest delay accepted for a waiting notification (one day).
+MAX_DELAY_SECONDS = 86400
+
+_scheduler_thread = None
+
+# Browser cache lifetime for the root-scoped PWA files, which only change on deploy.
+STATIC_MAX_AGE = 3600
+
 
-delayed_notifications = {}
+def _load_static(filename: str) -> tuple:
+    """Read a static file once, returning (bytes, etag)."""
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        data = f.read()
+    return data, hashlib.sha1(data).hexdigest()
+
+
+_service_worker = _load_static('sw.js')
+_manifest = _load_static('manifest.json')
+
+
+def _cacheable_response(data: bytes, etag: str, mimetype: str, max_age: int) -> Response:
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
 
 
 @app.route('/')
 def index():
     """Main PWA page - shows setup wizard or notification UI."""
-    db = Database()
+    db = get_db()
     if not db.is_setup_complete():
         return render_template('setup.html')
     return render_template('index.html')
@@ -48,15 +98,15 @@ def setup():
 @app.route('/sw.js')
 def service_worker():
     """Serve service worker from root scope."""
-    return send_from_directory(app.static_folder, 'sw.js',
-                               mimetype='application/javascript')
+    data, etag = _service_worker
+    return _cacheable_response(data, etag, 'application/javascript', STATIC_MAX_AGE)
 
 
 @app.route('/manifest.json')
 def manifest():
     """Serve PWA manifest from root."""
-    return send_from_directory(app.static_folder, 'manifest.json',
-                               mimetype='application/manifest+json')
+    data, etag = _manifest
+    return _cacheable_response(data, etag, 'application/manifest+json', STATIC_MAX_AGE)
 
 
 @app.route('/api/vapid-public-key')
@@ -75,7 +125,7 @@ def push_subscribe():
     if not data:
         return jsonify({'error': 'No subscription data'}), 400
 
-    db = Database()
+    db = get_db()
     try:
         db.save_push_subscription(data)
         return jsonify({'success': True})
@@ -93,7 +143,7 @@ def push_unsubscribe():
     if not data or not data.get('endpoint'):
         return jsonify({'error': 'No endpoint provided'}), 400
 
-    db = Database()
+    db = get_db()
     removed = db.remove_push_subscription(data['endpoint'])
     return jsonify({'success': removed})
 
@@ -126,7 +176,7 @@ def claude_notify():
     notification_type = data.get('notification_type', 'complete')
     project_path = data.get('project_path')
 
-    db = Database()
+    db = get_db()
     try:
         notification_id = db.save_claude_notification(
             notification_type=notification_type,
@@ -157,10 +207,12 @@ def claude_notify():
 
 def deliver_delayed_notification(notification_id: int):
     """Deliver a delayed notification after timeout."""
-    db = Database()
-    notification = db.get_claude_notification(notification_id)
+    db = get_db()
+    # Claiming marks the row delivered up front, so a concurrent cancel or a
+    # scheduler in another worker cannot also act on it.
+    notification = db.claim_pending_notification(notification_id)
 
-    if notification and notification['status'] == 'pending':
+    if notification:
         result = send_push_to_all(
             title=notification['title'],
             body=notification['body'] or 'Claude Code is waiting for your input',
@@ -168,11 +220,33 @@ def deliver_delayed_notification(notification_id: int):
             tag=f"claude-waiting-{notification_id}",
             require_interaction=True
         )
-        db.update_claude_notification_status(notification_id, 'delivered')
         logger.info(f"Delivered delayed notification {notification_id}: {result}")
 
-    if notification_id in delayed_notifications:
-        del delayed_notifications[notification_id]
+
+def _run_scheduler(interval: float):
+    """Deliver scheduled notifications as they come due."""
+    while True:
+        time.sleep(interval)
+        # Leave due rows pending until keys exist; claiming them now would
+        # mark them delivered without sending anything.
+        if not get_vapid_public_key():
+            continue
+        try:
+            for notification_id in get_db().get_due_notification_ids():
+                deliver_delayed_notification(notification_id)
+        except Exception as e:
+            logger.error(f"Scheduler failed to deliver notifications: {e}")
+
+
+def start_scheduler():
+    """Start the background thread that delivers delayed notifications."""
+    global _scheduler_thread
+    if _scheduler_thread is None:
+        _scheduler_thread = threading.Thread(
+            target=_run_scheduler, args=(SCHEDULER_INTERVAL,),
+            name='notification-scheduler', daemon=True
+        )
+        _scheduler_thread.start()
 
 
 @app.route('/api/claude/waiting', methods=['POST'])
@@ -185,21 +259,31 @@ def claude_waiting():
     title = data.get('title', 'Claude is waiting')
     body = data.get('body', 'Claude Code is waiting for your input')
     project_path = data.get('project_path')
-    delay_seconds = data.get('delay', 120)
-
-    db = Database()
+    delay = data.get('delay', 120)
+    # bool is an int subclass, so float(True) would quietly mean 1 second.
+    if isinstance(delay, bool):
+        return jsonify({'error': 'delay must be a number of seconds'}), 400
+    try:
+        delay_seconds = float(delay)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'delay must be a number of seconds'}), 400
+    # NaN fails both comparisons; huge delays overflow SQLite's datetime()
+    # into a NULL scheduled_at that the scheduler never picks up.
+    if not 0 <= delay_seconds <= MAX_DELAY_SECONDS:
+        return jsonify({'error': f'delay must be between 0 and {MAX_DELAY_SECONDS} seconds'}), 400
+    if delay_seconds.is_integer():
+        delay_seconds = int(delay_seconds)
+
+    db = get_db()
     try:
         notification_id = db.save_claude_notification(
             notification_type='waiting',
             title=title,
             body=body,
-            project_path=project_path
+            project_path=project_path,
+            delay_seconds=delay_seconds
         )
 
-        timer = Timer(delay_seconds, deliver_delayed_notification, [notification_id])
-        timer.start()
-        delayed_notifications[notification_id] = timer
-
         return jsonify({
             'success': True,
             'id': notification_id,
@@ -214,13 +298,8 @@ def claude_waiting():
 @app.route('/api/claude/cancel/<int:notification_id>', methods=['POST'])
 def claude_cancel(notification_id: int):
     """Cancel a pending delayed notification."""
-    if notification_id in delayed_notifications:
-        delayed_notifications[notification_id].cancel()
-        del delayed_notifications[notification_id]
-
-        db = Database()
-        db.update_claude_notification_status(notification_id, 'cancelled')
-
+    db = get_db()
+    if db.cancel_pending_notification(notification_id):
         return jsonify({'success': True, 'cancelled': notification_id})
 
     return jsonify({'success': False, 'error': 'Notification not found or already delivered'}), 404
@@ -230,7 +309,7 @@ def claude_cancel(notification_id: int):
 def claude_history():
     """Get Claude notification history."""
     limit = request.args.get('limit', 50, type=int)
-    db = Database()
+    db = get_db()
     notifications = db.get_claude_notification_history(limit)
     return jsonify(notifications)
 
@@ -238,7 +317,7 @@ def claude_history():
 @app.route('/api/setup/status')
 def setup_status():
     """Check if setup is complete."""
-    db = Database()
+    db = get_db()
     vapid_key = get_vapid_public_key()
     return jsonify({
         'setup_complete': db.is_setup_complete(),
@@ -250,7 +329,7 @@ def setup_status():
 @app.route('/api/setup/complete', methods=['POST'])
 def setup_complete():
     """Mark setup as complete."""
-    db = Database()
+    db = get_db()
     db.mark_setup_complete()
     return jsonify({'success': True})
 
@@ -265,22 +344,28 @@ def setup_generate_vapid():
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
         logger.info(f"Writing VAPID keys to: {env_path}")
 
-        existing_lines = []
+        existing = ''
         if os.path.exists(env_path):
             with open(env_path, 'r') as f:
-                existing_lines = [
-                    line for line in f.readlines()
-                    if not line.startswith('VAPID_PRIVATE_KEY=')
-                    and not line.startswith('VAPID_PUBLIC_KEY=')
-                ]
-
+                # python-dotenv's parser also recognizes `export VAPID_...=`
+                # and quoted entries, which a prefix match would miss.
+                existing = ''.join(
+                    binding.original.string for binding in parse_stream(f)
+                    if binding.key not in ('VAPID_PRIVATE_KEY', 'VAPID_PUBLIC_KEY')
+                )
+
+        # Rewritten in place rather than with dotenv.set_key, which renames
+        # a temp file over .env and fails on Docker's single-file bind mount.
         with open(env_path, 'w') as f:
-            f.writelines(existing_lines)
-            f.write(f"\nVAPID_PRIVATE_KEY={keys['private_key']}\n")
+            f.write(existing)
+            if existing and not existing.endswith('\n'):
+                f.write('\n')
+            f.write(f"VAPID_PRIVATE_KEY={keys['private_key']}\n")
             f.write(f"VAPID_PUBLIC_KEY={keys['public_key']}\n")
 
         os.environ['VAPID_PRIVATE_KEY'] = keys['private_key']
         os.environ['VAPID_PUBLIC_KEY'] = keys['public_key']
+        set_vapid_keys(keys['private_key'], keys['public_key'])
 
         return jsonify({
             'success': True,
@@ -294,13 +379,11 @@ def setup_generate_vapid():
         }), 500
 
 
-@app.route('/api/qrcode')
-def generate_qrcode():
-    """Generate QR code for the current URL."""
+@functools.lru_cache(maxsize=64)
+def _render_qrcode(url: str) -> tuple:
+    """Render a QR code PNG for url, returning (png_bytes, etag)."""
     import qrcode
 
-    url = request.args.get('url', request.host_url)
-
     qr = qrcode.QRCode(version=1, box_size=10, border=4)
     qr.add_data(url)
     qr.make(fit=True)
@@ -309,9 +392,18 @@ def generate_qrcode():
 
     buf = io.BytesIO()
     img.save(buf, format='PNG')
-    buf.seek(0)
+    png = buf.getvalue()
 
-    return Response(buf.getvalue(), mimetype='image/png')
+    return png, hashlib.sha1(png).hexdigest()
+
+
+@app.route('/api/qrcode')
+def generate_qrcode():
+    """Generate QR code for the current URL."""
+    url = request.args.get('url', request.host_url)
+
+    png, etag = _render_qrcode(url)
+    return _cacheable_response(png, etag, 'image/png', 86400)
 
 
 @app.route('/health')
@@ -320,6 +412,9 @@ def health():
     return jsonify({'status': 'healthy'})
 
 
+start_scheduler()
+
+
 if __name__ == '__main__':
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
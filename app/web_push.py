@@ -4,13 +4,27 @@ Web Push Notification Module for Claude Notify PWA.
 """
 
 import os
-import json
+import hmac
+import time
+import base64
+import hashlib
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from urllib.parse import urlparse
 
-from pywebpush import webpush, WebPushException
+import orjson
+import requests
+from dotenv import dotenv_values
+from requests.adapters import HTTPAdapter
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF, HKDFExpand
+from py_vapid import Vapid
 
-from app.database import Database
+from app.database import get_db
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +32,77 @@ VAPID_PRIVATE_KEY = os.environ.get('VAPID_PRIVATE_KEY', '')
 VAPID_PUBLIC_KEY = os.environ.get('VAPID_PUBLIC_KEY', '')
 VAPID_EMAIL = os.environ.get('VAPID_EMAIL', 'mailto:admin@example.com')
 
+# Upper bound on concurrent push requests per broadcast.
+MAX_SEND_WORKERS = 32
 
-def get_vapid_private_key_pem() -> str:
-    """Convert stored key to PEM format for pywebpush."""
-    import base64
-    key = VAPID_PRIVATE_KEY
+# Lifetime of a signed VAPID token (the spec allows at most 24h).
+VAPID_TOKEN_TTL = 12 * 60 * 60
+
+# Signed VAPID headers are reused within one bucket of this many seconds.
+VAPID_SIGN_INTERVAL = 60 * 60
+
+# Seconds to wait on a push service before counting the send as failed.
+PUSH_TIMEOUT = 10
+
+# aes128gcm record size. Payloads are limited so they fit in one record.
+RECORD_SIZE = 4096
+
+# Largest payload _encrypt() accepts. Push services cap the encrypted
+# body at 4096 bytes: the 86 byte header (salt, rs, key id) plus one
+# record holding the payload, its 0x02 delimiter and the 16 byte tag.
+MAX_PAYLOAD_SIZE = RECORD_SIZE - 86 - 17
+
+
+def _new_push_session() -> requests.Session:
+    # Subscriptions cluster on a few push services (FCM, Apple, Mozilla), so
+    # keeping connections alive per host saves a TLS handshake per send.
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=MAX_SEND_WORKERS))
+    return session
+
+
+_push_session = _new_push_session()
+
+
+ENV_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
+
+_env_mtime = None
+
+
+def _load_vapid_from_env():
+    """Pick up VAPID keys from the .env file whenever it changes.
+
+    Only the gunicorn worker that serves /api/setup/generate-vapid sees
+    set_vapid_keys(); the others notice the rewritten .env through its
+    mtime. Unchanged files cost a single stat().
+    """
+    global VAPID_PUBLIC_KEY, VAPID_PRIVATE_KEY, _env_mtime
+
+    try:
+        mtime = os.stat(ENV_PATH).st_mtime_ns
+    except OSError:
+        return
+    if mtime == _env_mtime:
+        return
+    _env_mtime = mtime
+
+    values = dotenv_values(ENV_PATH)
+    VAPID_PUBLIC_KEY = values.get('VAPID_PUBLIC_KEY') or VAPID_PUBLIC_KEY
+    VAPID_PRIVATE_KEY = values.get('VAPID_PRIVATE_KEY') or VAPID_PRIVATE_KEY
+
+
+_load_vapid_from_env()
+
+
+def set_vapid_keys(private_key: str, public_key: str):
+    """Replace the in-process VAPID keys, e.g. after generating new ones."""
+    global VAPID_PUBLIC_KEY, VAPID_PRIVATE_KEY
+    VAPID_PRIVATE_KEY = private_key
+    VAPID_PUBLIC_KEY = public_key
+
+
+@functools.lru_cache(maxsize=1)
+def _private_key_to_pem(key: str) -> str:
     if not key:
         return ''
     # If already PEM, return as-is
@@ -39,15 +119,47 @@ def get_vapid_private_key_pem() -> str:
         return key
 
 
+def get_vapid_private_key_pem() -> str:
+    """Convert stored key to PEM format for VAPID signing."""
+    return _private_key_to_pem(VAPID_PRIVATE_KEY)
+
+
+@functools.lru_cache(maxsize=1)
+def _vapid_signer(pem: str) -> Vapid:
+    return Vapid.from_pem(pem.encode('utf-8'))
+
+
+def _audience(endpoint: str) -> str:
+    """The VAPID 'aud' claim for an endpoint: its push service origin."""
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+@functools.lru_cache(maxsize=32)
+def _signed_vapid_headers(pem: str, aud: str, exp_bucket: int) -> dict:
+    # Expiry is pinned to the bucket so the token stays valid for at least
+    # VAPID_TOKEN_TTL after the last time it is handed out.
+    claims = {
+        "aud": aud,
+        "sub": VAPID_EMAIL,
+        "exp": (exp_bucket + 1) * VAPID_SIGN_INTERVAL + VAPID_TOKEN_TTL
+    }
+    return _vapid_signer(pem).sign(claims)
+
+
+def _vapid_headers(aud: str) -> dict:
+    """VAPID headers for one push service, re-signed once per VAPID_SIGN_INTERVAL.
+
+    The returned dict is shared between callers and must not be modified.
+    """
+    return _signed_vapid_headers(get_vapid_private_key_pem(), aud,
+                                 int(time.time()) // VAPID_SIGN_INTERVAL)
+
+
 def generate_vapid_keys() -> dict:
     """Generate a new VAPID key pair."""
-    import base64
-    from cryptography.hazmat.primitives import serialization
-    from cryptography.hazmat.primitives.asymmetric import ec
-    from cryptography.hazmat.backends import default_backend
-
     # Generate EC key directly
-    private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    private_key = ec.generate_private_key(ec.SECP256R1())
 
     # Get private key as DER format, base64 encoded (single line for .env compatibility)
     private_der = private_key.private_bytes(
@@ -71,20 +183,123 @@ def generate_vapid_keys() -> dict:
 
 
 def get_vapid_public_key() -> str:
-    """Get the VAPID public key, generating if needed."""
-    global VAPID_PUBLIC_KEY, VAPID_PRIVATE_KEY
+    """Get the VAPID public key."""
+    _load_vapid_from_env()
+    return VAPID_PUBLIC_KEY
 
-    if not VAPID_PUBLIC_KEY:
-        env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
-        if os.path.exists(env_path):
-            with open(env_path, 'r') as f:
-                for line in f:
-                    if line.startswith('VAPID_PUBLIC_KEY='):
-                        VAPID_PUBLIC_KEY = line.split('=', 1)[1].strip()
-                    elif line.startswith('VAPID_PRIVATE_KEY='):
-                        VAPID_PRIVATE_KEY = line.split('=', 1)[1].strip()
 
-    return VAPID_PUBLIC_KEY
+SENT = 'sent'
+FAILED = 'failed'
+EXPIRED = 'expired'
+
+
+def _build_payload(title: str, body: str, url: str, tag: str,
+                   require_interaction: bool, actions: Optional[list]) -> bytes:
+    """Serialize a notification, truncating body then title to MAX_PAYLOAD_SIZE.
+
+    Raises ValueError if the remaining fields alone are too large.
+    """
+    message = {
+        "title": title,
+        "body": body,
+        "url": url,
+        "tag": tag,
+        "requireInteraction": require_interaction,
+        "actions": actions or []
+    }
+    payload = orjson.dumps(message)
+    if len(payload) <= MAX_PAYLOAD_SIZE:
+        return payload
+
+    logger.warning(f"Push payload is {len(payload)} bytes, truncating to {MAX_PAYLOAD_SIZE}")
+    for field in ('body', 'title'):
+        if len(payload) <= MAX_PAYLOAD_SIZE or not message[field]:
+            continue
+        # JSON escaping makes the encoded size non-linear in the text, so
+        # binary search for the longest prefix (in bytes) that still fits.
+        text = message[field].encode('utf-8')
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            message[field] = text[:mid].decode('utf-8', 'ignore') + '…'
+            if len(orjson.dumps(message)) <= MAX_PAYLOAD_SIZE:
+                low = mid
+            else:
+                high = mid - 1
+        message[field] = text[:low].decode('utf-8', 'ignore') + '…' if low else ''
+        payload = orjson.dumps(message)
+
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"Push payload is {len(payload)} bytes, limit is {MAX_PAYLOAD_SIZE}")
+    return payload
+
+
+@functools.lru_cache(maxsize=1024)
+def _subscription_keys(p256dh: bytes, auth: bytes) -> tuple:
+    """Parse a subscription's raw keys once: (public key, raw point, auth secret)."""
+    ua_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), p256dh)
+    return ua_key, p256dh, auth
+
+
+def _encrypt(payload: bytes, ua_key: ec.EllipticCurvePublicKey,
+             ua_public: bytes, auth_secret: bytes) -> bytes:
+    """Encrypt a payload for one recipient (RFC 8291, aes128gcm encoding)."""
+    as_key = ec.generate_private_key(ec.SECP256R1())
+    as_public = as_key.public_key().public_bytes(
+        encoding=serialization.Encoding.X962,
+        format=serialization.PublicFormat.UncompressedPoint
+    )
+    ecdh_secret = as_key.exchange(ec.ECDH(), ua_key)
+
+    ikm = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=auth_secret,
+        info=b'WebPush: info\x00' + ua_public + as_public
+    ).derive(ecdh_secret)
+
+    salt = os.urandom(16)
+    prk = hmac.new(salt, ikm, hashlib.sha256).digest()
+    cek = HKDFExpand(hashes.SHA256(), 16, b'Content-Encoding: aes128gcm\x00').derive(prk)
+    nonce = HKDFExpand(hashes.SHA256(), 12, b'Content-Encoding: nonce\x00').derive(prk)
+
+    # A single record, terminated by the 0x02 last-record delimiter.
+    ciphertext = AESGCM(cek).encrypt(nonce, payload + b'\x02', None)
+
+    header = salt + RECORD_SIZE.to_bytes(4, 'big') + bytes([len(as_public)]) + as_public
+    return header + ciphertext
+
+
+def _send_one(subscription: dict, payload: bytes, vapid_headers: dict) -> str:
+    """Send an encoded payload to one subscription and return its outcome.
+
+    vapid_headers must have been signed for the subscription's push service,
+    see _vapid_headers().
+
+    Returns SENT, FAILED, or EXPIRED when the push service reports the
+    subscription is gone (404/410). The caller decides what to do with
+    expired subscriptions so broadcasts can remove them in one batch.
+    """
+    headers = {
+        **vapid_headers,
+        "Content-Encoding": "aes128gcm",
+        "Content-Type": "application/octet-stream",
+        "TTL": "0"
+    }
+
+    try:
+        body = _encrypt(payload, *_subscription_keys(subscription['p256dh'], subscription['auth']))
+        response = _push_session.post(subscription['endpoint'], data=body,
+                                      headers=headers, timeout=PUSH_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Unexpected error sending push: {e}")
+        return FAILED
+
+    if response.status_code in [404, 410]:
+        logger.info(f"Subscription expired, removing: {subscription['endpoint'][:50]}...")
+        return EXPIRED
+    if response.status_code > 202:
+        logger.error(f"Push notification failed: {response.status_code} {response.reason}")
+        return FAILED
+    return SENT
 
 
 def send_push_notification(
@@ -97,49 +312,26 @@ def send_push_notification(
     actions: list = None
 ) -> bool:
     """Send a push notification to a single subscription."""
-    global VAPID_PRIVATE_KEY, VAPID_PUBLIC_KEY
-
+    _load_vapid_from_env()
     if not all([VAPID_PRIVATE_KEY, VAPID_PUBLIC_KEY]):
         logger.error("VAPID keys not configured")
         return False
 
-    payload = json.dumps({
-        "title": title,
-        "body": body,
-        "url": url,
-        "tag": tag,
-        "requireInteraction": require_interaction,
-        "actions": actions or []
-    })
-
-    subscription_info = {
-        "endpoint": subscription['endpoint'],
-        "keys": {
-            "p256dh": subscription['p256dh'],
-            "auth": subscription['auth']
-        }
-    }
-
     try:
-        webpush(
-            subscription_info=subscription_info,
-            data=payload,
-            vapid_private_key=get_vapid_private_key_pem(),
-            vapid_claims={"sub": VAPID_EMAIL}
-        )
-        logger.info(f"Push notification sent: {title}")
-        return True
-    except WebPushException as e:
-        logger.error(f"Push notification failed: {e}")
-        if e.response and e.response.status_code in [404, 410]:
-            logger.info(f"Subscription expired, removing: {subscription['endpoint'][:50]}...")
-            db = Database()
-            db.remove_push_subscription(subscription['endpoint'])
-        return False
+        vapid_headers = _vapid_headers(_audience(subscription['endpoint']))
+        payload = _build_payload(title, body, url, tag, require_interaction, actions)
     except Exception as e:
-        logger.error(f"Unexpected error sending push: {e}")
+        logger.error(f"Failed to prepare push notification: {e}")
         return False
 
+    outcome = _send_one(subscription, payload, vapid_headers)
+
+    if outcome == SENT:
+        logger.info(f"Push notification sent: {title}")
+    elif outcome == EXPIRED:
+        get_db().remove_push_subscription(subscription['endpoint'])
+    return outcome == SENT
+
 
 def send_push_to_all(
     title: str,
@@ -150,26 +342,53 @@ def send_push_to_all(
     actions: list = None
 ) -> dict:
     """Send a push notification to all subscribed devices."""
-    db = Database()
+    _load_vapid_from_env()
+    db = get_db()
     subscriptions = db.get_all_push_subscriptions()
 
     results = {"sent": 0, "failed": 0}
 
-    for sub in subscriptions:
-        success = send_push_notification(
-            subscription=sub,
-            title=title,
-            body=body,
-            url=url,
-            tag=tag,
-            require_interaction=require_interaction,
-            actions=actions
-        )
-        if success:
+    if subscriptions and not all([VAPID_PRIVATE_KEY, VAPID_PUBLIC_KEY]):
+        logger.error("VAPID keys not configured")
+        results["failed"] = len(subscriptions)
+        return results
+
+    # The payload is identical for every recipient, and a VAPID token only
+    # depends on the push service, so both are built once per broadcast.
+    try:
+        payload = _build_payload(title, body, url, tag, require_interaction, actions)
+        headers_by_aud = {
+            aud: _vapid_headers(aud)
+            for aud in {_audience(sub['endpoint']) for sub in subscriptions}
+        }
+    except Exception as e:
+        logger.error(f"Failed to prepare push notification: {e}")
+        results["failed"] = len(subscriptions)
+        return results
+
+    used = []
+    expired = []
+
+    def send(sub: dict) -> str:
+        return _send_one(sub, payload, headers_by_aud[_audience(sub['endpoint'])])
+
+    outcomes = []
+    if subscriptions:
+        # Each send is independent blocking I/O, so fan out over threads.
+        with ThreadPoolExecutor(max_workers=min(MAX_SEND_WORKERS, len(subscriptions))) as executor:
+            outcomes = list(executor.map(send, subscriptions))
+
+    for sub, outcome in zip(subscriptions, outcomes):
+        if outcome == SENT:
             results["sent"] += 1
-            db.update_push_subscription_last_used(sub['endpoint'])
+            used.append(sub['endpoint'])
         else:
             results["failed"] += 1
+            if outcome == EXPIRED:
+                expired.append(sub['endpoint'])
+
+    db.mark_endpoints_used(used)
+    db.remove_push_subscriptions(expired)
 
     logger.info(f"Push notifications: {results['sent']} sent, {results['failed']} failed")
     return results
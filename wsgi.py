@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""
+WSGI entry point for Claude Notify.
+
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+"""
+
+from app.main import app
+
+__all__ = ['app']